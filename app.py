@@ -1,111 +1,408 @@
+import atexit
+import collections
+import contextlib
+import copy
+import hashlib
 import os
-import shutil
-import openpyxl
+import queue
+import threading
+import time
+import zipfile
+import requests
 import smartsheet
-import pandas as pd
 import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify
+from logging.handlers import QueueHandler, QueueListener
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
 
 app = Flask(__name__)
 
+# Log records are queued and written by a listener thread, off the request and worker threads
+_log_queue = queue.Queue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+logging.getLogger().addHandler(QueueHandler(_log_queue))
+logging.getLogger().setLevel(logging.INFO)
+_log_listener = QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)  # Flush records still queued at shutdown
+log = logging.getLogger("smartsheet")
+
 # === Configuration ===
 API_KEY = os.getenv("SMARTSHEET_API_KEY")  # Use environment variable
 SHEET_ID = int(os.getenv("SMARTSHEET_SHEET_ID"))  # Store as env variable 
+FILTER_ID = os.getenv("SMARTSHEET_FILTER_ID")  # Optional saved sheet filter showing only checked rows
 
 TEMPLATE_PATH = r"Updated Schedule.xlsx"  # Keep this file in your project folder
 OUTPUT_DIRECTORY = r"property_folders"  # Directory to store generated files
+XLSX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Smartsheet column title -> template cell
+MAPPING_POSITIONS = {
+    "Property Address": "B3",
+    "Local authority": "B5",
+    "EPC Score ( Rd SAP)": "B6",
+    "Tenure": "B7",
+}
+SHEET_COLUMNS = [*MAPPING_POSITIONS, "Check Box"]  # Columns fetched when scanning the whole sheet
+
+# Unzip the template once; each property file is these parts with the sheet XML patched
+TEMPLATE_SHEET_PART = "xl/worksheets/sheet1.xml"
+SHEET_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+with zipfile.ZipFile(TEMPLATE_PATH) as template_zip:
+    TEMPLATE_PARTS = {name: template_zip.read(name) for name in template_zip.namelist()}
+# Part of every generated file's content hash, so editing the template invalidates them
+TEMPLATE_DIGEST = hashlib.blake2b(b"".join(TEMPLATE_PARTS.values())).hexdigest()
+
+# Parsed once; each property works on a deep copy instead of re-parsing the XML
+TEMPLATE_SHEET = etree.fromstring(TEMPLATE_PARTS[TEMPLATE_SHEET_PART])
+_template_sheet_lock = threading.Lock()
+
+
+def template_cell_path(cell_ref):
+    """Return the child indexes leading from the sheet root to a template cell."""
+    cells = TEMPLATE_SHEET.xpath("//s:c[@r=$ref]", namespaces={"s": SHEET_NS}, ref=cell_ref)
+    if not cells:
+        raise RuntimeError(f"Template cell {cell_ref} is missing from {TEMPLATE_SHEET_PART}")
+    path = []
+    node = cells[0]
+    while node is not TEMPLATE_SHEET:
+        parent = node.getparent()
+        path.append(parent.index(node))
+        node = parent
+    return tuple(reversed(path))
+
+
+# A deep copy keeps the same element layout, so each mapped cell is found once here and
+# then reached on every copy by indexing instead of re-running the XPath search
+TEMPLATE_CELL_PATHS = {key: template_cell_path(cell_ref) for key, cell_ref in MAPPING_POSITIONS.items()}
+
+COLUMN_MAP_TTL = 300  # Seconds before the cached column map is refreshed
+FILE_WORKERS = min(16, (os.cpu_count() or 1) * 4)  # Threads generating and uploading property files
+WEBHOOK_WORKERS = 2  # Background threads processing webhook rows
+FILE_LOCK_TTL = 60  # Seconds an unused per-file lock is kept
+UPLOAD_ATTEMPTS = 5  # Tries per attachment upload on rate-limit, server or connection errors
+UPLOAD_TIMEOUT = (10, 120)  # Connect and read timeouts, in seconds, for an attachment upload
+UPLOAD_MAX_BACKOFF = 60  # Longest wait, in seconds, between upload attempts
+
+API_BASE = "https://api.smartsheet.eu/2.0"  # Use EU API base if required
 
 # Initialize Smartsheet client
-client = smartsheet.Smartsheet(API_KEY, api_base="https://api.smartsheet.eu/2.0")  # Use EU API base if required
+client = smartsheet.Smartsheet(API_KEY, api_base=API_BASE)
 client.errors_as_exceptions(True)  # Raise exceptions for better error handling
 
+# Shared session for direct REST calls (attachment uploads), so connections are reused.
+# Uploads run on the FILE_WORKERS pool, so size the connection pool to match.
+HTTP = requests.Session()
+HTTP.headers.update({"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"})
+HTTP.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=FILE_WORKERS))
+
+
+def fetch_smartsheet_data(row_ids=None):
+    """Fetch (row id, row data) pairs from Smartsheet where 'Check Box' is checked.
 
-def fetch_smartsheet_data():
-    """Fetch data from Smartsheet where 'Check Box' is checked."""
+    Scans the whole sheet, or only the given rows when row_ids is passed.
+    """
     try:
-        sheet = client.Sheets.get_sheet(SHEET_ID)
+        # Only pull the columns the template needs, and let a saved filter drop unchecked rows
+        get_column_map()
+        if any(title not in TITLE_TO_ID for title in SHEET_COLUMNS):
+            get_column_map(refresh=True)
+        missing = [title for title in SHEET_COLUMNS if title not in TITLE_TO_ID]
+        if missing:
+            log.warning("⚠️ Sheet has no column(s) %s; they will be left out of the scan", missing)
+        column_ids = [TITLE_TO_ID[title] for title in SHEET_COLUMNS if title in TITLE_TO_ID]
+        sheet = client.Sheets.get_sheet(
+            SHEET_ID,
+            row_ids=row_ids,
+            column_ids=column_ids,
+            filter_id=FILTER_ID,
+            exclude="nonexistentCells,filteredOutRows",
+        )
         column_map = {col.id: col.title for col in sheet.columns}
-        sheet_data, row_id_map = [], {}
+        checked_rows = []
 
         for row in sheet.rows:
-            row_data = {column_map[cell.column_id]: cell.value for cell in row.cells if cell.value}
+            row_data = {
+                column_map[cell.column_id]: cell.value
+                for cell in row.cells
+                if cell.value and cell.column_id in column_map
+            }
             if row_data.get("Check Box") is True:
-                sheet_data.append(row_data)
-                if "Property Address" in row_data:
-                    row_id_map[row_data["Property Address"]] = row.id
+                checked_rows.append((row.id, row_data))
 
-        return pd.DataFrame(sheet_data), row_id_map
+        return checked_rows
 
     except smartsheet.exceptions.ApiError as e:
-        print(f"❌ Smartsheet API Error: {e}")
-        return None, {}
-
-
-def create_property_files(df):
-    """Generate Excel files for each checked property row."""
-    if not os.path.exists(OUTPUT_DIRECTORY):
-        os.makedirs(OUTPUT_DIRECTORY)
-
-    mapping_positions = {
-        "Property Address": "B3",
-        "Local authority": "B5",
-        "EPC Score ( Rd SAP)": "B6",
-        "Tenure": "B7",
-    }
-
-    for _, row in df.iterrows():
-        property_address = row.get("Property Address")
-        if not property_address:
-            continue
-
-        property_folder = os.path.join(OUTPUT_DIRECTORY, property_address)
-        os.makedirs(property_folder, exist_ok=True)
-        property_file_path = os.path.join(property_folder, f"{property_address}.xlsx")
-        shutil.copy(TEMPLATE_PATH, property_file_path)
-
-        wb = openpyxl.load_workbook(property_file_path)
-        ws = wb.active
-
-        for key, cell_ref in mapping_positions.items():
-            if key in row and row[key]:
-                ws[cell_ref] = row[key]
+        log.error("❌ Smartsheet API Error: %s", e)
+        return []
+
+
+# Column schema cache, shared by all requests
+COLUMN_MAP, TITLE_TO_ID = {}, {}
+_column_map_loaded_at = 0.0
+_column_map_lock = threading.Lock()
+
+
+def get_column_map(refresh=False):
+    """Return the cached column-id -> title map, reloading it when stale."""
+    global COLUMN_MAP, TITLE_TO_ID, _column_map_loaded_at
+
+    with _column_map_lock:
+        if refresh or not COLUMN_MAP or time.monotonic() - _column_map_loaded_at > COLUMN_MAP_TTL:
+            columns = client.Sheets.get_columns(SHEET_ID, include_all=True)
+            COLUMN_MAP = {col.id: col.title for col in columns.data}
+            TITLE_TO_ID = {title: col_id for col_id, title in COLUMN_MAP.items()}
+            _column_map_loaded_at = time.monotonic()
+        return COLUMN_MAP
+
+
+def is_check_box_event(event):
+    """Return True if a webhook event may have ticked the 'Check Box' column.
+
+    Smartsheet cell events only carry the changed column's id, so they can't say whether the
+    box was ticked or cleared; the fetched row's value is checked before anything is built.
+    """
+    if "columnId" in event:
+        # Before the column map is first loaded the id can't be matched, so let the row check decide
+        check_box_id = TITLE_TO_ID.get("Check Box")
+        return check_box_id is None or event["columnId"] == check_box_id
+
+    changes = event.get("changedColumns")
+    return isinstance(changes, list) and any(
+        isinstance(change, dict) and change.get("columnTitle") == "Check Box" and change.get("newValue") is True
+        for change in changes
+    )
+
+
+def property_file_path(property_address):
+    """Return where the Excel file for a property address is generated."""
+    return os.path.join(OUTPUT_DIRECTORY, property_address, f"{property_address}.xlsx")
+
+
+def create_property_file(row_data):
+    """Generate the Excel file for a single property row and return its path."""
+    property_address = row_data.get("Property Address")
+    if not property_address:
+        return None
+
+    excel_file_path = property_file_path(property_address)
+    property_folder = os.path.dirname(excel_file_path)
+    os.makedirs(property_folder, exist_ok=True)
+
+    # Skip regenerating when a retriggered row would produce an identical file
+    content_hash = property_file_hash(row_data)
+    hash_path = excel_file_path + ".hash"
+    if os.path.exists(excel_file_path) and os.path.exists(hash_path):
+        with open(hash_path) as hash_file:
+            if hash_file.read() == content_hash:
+                return excel_file_path
+
+    # Drop the old hash first so a build that dies part-way can never look like a cache hit
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(hash_path)
+
+    with _template_sheet_lock:
+        sheet = copy.deepcopy(TEMPLATE_SHEET)
+    for key, cell_path in TEMPLATE_CELL_PATHS.items():
+        if row_data.get(key):
+            cell = sheet
+            for index in cell_path:
+                cell = cell[index]
+            set_cell_value(cell, row_data[key])
+
+    # Write to a temporary file and swap it in, so the workbook is never left half-written.
+    # The caller holds this path's file lock, so a fixed name is safe, and a plain open keeps
+    # the usual umask permissions that mkstemp's 0600 would have replaced
+    tmp_path = excel_file_path + ".tmp"
+    try:
+        with open(tmp_path, 'wb') as tmp_file, zipfile.ZipFile(tmp_file, 'w', zipfile.ZIP_DEFLATED) as xlsx:
+            for name, data in TEMPLATE_PARTS.items():
+                if name == TEMPLATE_SHEET_PART:
+                    data = etree.tostring(sheet, xml_declaration=True, encoding="UTF-8", standalone=True)
+                xlsx.writestr(name, data)
+        os.replace(tmp_path, excel_file_path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+    with open(hash_path, 'w') as hash_file:
+        hash_file.write(content_hash)
+    return excel_file_path
+
+
+def property_file_hash(row_data):
+    """Return a hash of the template and the row values written into it."""
+    values = {key: row_data.get(key) for key in MAPPING_POSITIONS}
+    payload = json.dumps([TEMPLATE_DIGEST, values], sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode()).hexdigest()
+
+
+def set_cell_value(cell, value):
+    """Overwrite a worksheet <c> element's value, keeping its style."""
+    for child in list(cell):
+        cell.remove(child)
+
+    if isinstance(value, bool):
+        cell.set("t", "b")
+        etree.SubElement(cell, f"{{{SHEET_NS}}}v").text = "1" if value else "0"
+    elif isinstance(value, (int, float)):
+        cell.attrib.pop("t", None)
+        etree.SubElement(cell, f"{{{SHEET_NS}}}v").text = str(value)
+    else:
+        # Inline strings avoid touching the shared string table
+        cell.set("t", "inlineStr")
+        text = etree.SubElement(etree.SubElement(cell, f"{{{SHEET_NS}}}is"), f"{{{SHEET_NS}}}t")
+        text.text = str(value)
+        text.set("{http://www.w3.org/XML/1998/namespace}space", "preserve")
+
+
+def attach_excel_file_to_smartsheet(row_id, excel_file_path):
+    """Attach a single generated Excel file to its Smartsheet row, streaming it from disk.
+
+    Rate-limit (429) and server (5xx) responses and connection failures are retried up to
+    UPLOAD_ATTEMPTS times, waiting for Retry-After when Smartsheet sends one.
+    """
+    log.info("📤 Attaching %s to Smartsheet row %s", excel_file_path, row_id)
+
+    for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+        retry_after = None
+        try:
+            # A MultipartEncoder stream can't be rewound, so each attempt reopens the file
+            with open(excel_file_path, 'rb') as file:
+                encoder = MultipartEncoder(fields={"file": (os.path.basename(excel_file_path), file, XLSX_MIME_TYPE)})
+                response = HTTP.post(
+                    f"{API_BASE}/sheets/{SHEET_ID}/rows/{row_id}/attachments",
+                    data=encoder,
+                    headers={"Content-Type": encoder.content_type},
+                    timeout=UPLOAD_TIMEOUT,
+                )
+        except requests.ConnectionError as e:
+            error = e
+        except requests.RequestException as e:
+            # A read timeout may mean the upload landed, so don't risk a duplicate attachment
+            log.error("❌ Smartsheet API Error: %s", e)
+            return False
+        else:
+            if response.ok:
+                log.info("✅ Successfully attached: %s", excel_file_path)
+                return True
+            error = f"{response.status_code} {response.text}"
+            if response.status_code != 429 and response.status_code < 500:
+                log.error("❌ Smartsheet API Error: %s", error)
+                return False
+            retry_after = response.headers.get("Retry-After")
+
+        if attempt < UPLOAD_ATTEMPTS:
+            delay = upload_retry_delay(retry_after, attempt)
+            log.warning("⏳ Attaching %s failed (%s); retrying in %.0fs", excel_file_path, error, delay)
+            time.sleep(delay)
+
+    log.error("❌ Smartsheet API Error: giving up on %s after %d attempts: %s", excel_file_path, UPLOAD_ATTEMPTS, error)
+    return False
+
+
+def upload_retry_delay(retry_after, attempt):
+    """Return the seconds to wait before retrying an upload, honouring Retry-After."""
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        delay = 2 ** attempt
+    return min(max(delay, 0), UPLOAD_MAX_BACKOFF)
+
+
+# Locks keyed by generated file path, so two rows for the same property never
+# build or upload that file at the same time
+FILE_LOCKS = collections.defaultdict(threading.Lock)
+_file_lock_last_used = {}
+LOCKS_GUARD = threading.Lock()
+
+
+def file_lock(excel_file_path):
+    """Return the lock for a property file, dropping locks that have been idle for FILE_LOCK_TTL."""
+    now = time.monotonic()
+    with LOCKS_GUARD:
+        for idle_path, last_used in list(_file_lock_last_used.items()):
+            if now - last_used > FILE_LOCK_TTL and not FILE_LOCKS[idle_path].locked():
+                del FILE_LOCKS[idle_path], _file_lock_last_used[idle_path]
+        _file_lock_last_used[excel_file_path] = now
+        return FILE_LOCKS[excel_file_path]
+
+
+def process_property(row_id, row_data):
+    """Generate a checked row's Excel file and attach it, holding the file's lock throughout."""
+    property_address = row_data.get("Property Address")
+    if not property_address:
+        return
+
+    excel_file_path = property_file_path(property_address)
+    content_hash = property_file_hash(row_data)
+    with file_lock(excel_file_path):
+        create_property_file(row_data)
+
+        # Smartsheet would store a re-upload as a new attachment, so only upload content the row doesn't have yet
+        attached_hashes = read_attached_hashes(excel_file_path)
+        if attached_hashes.get(str(row_id)) == content_hash:
+            log.info("⏭️ %s is unchanged and already attached to row %s", excel_file_path, row_id)
+            return
+
+        if attach_excel_file_to_smartsheet(row_id, excel_file_path):
+            attached_hashes[str(row_id)] = content_hash
+            with open(excel_file_path + ".attached", 'w') as attached_file:
+                json.dump(attached_hashes, attached_file)
+
+
+def read_attached_hashes(excel_file_path):
+    """Return the row id -> content hash map of successful uploads of a property file."""
+    try:
+        with open(excel_file_path + ".attached") as attached_file:
+            return json.load(attached_file)
+    except (FileNotFoundError, ValueError):
+        return {}
 
-        wb.save(property_file_path)
 
-    print("✅ Excel files generated successfully.")
+# Shared by the webhook workers and the sync command, so concurrency stays bounded by FILE_WORKERS
+_file_pool = ThreadPoolExecutor(max_workers=FILE_WORKERS, thread_name_prefix="property-file")
 
 
-def attach_excel_files_to_smartsheet(row_id_map):
-    """Attach generated Excel files to corresponding Smartsheet rows."""
-    for property_folder in os.listdir(OUTPUT_DIRECTORY):
-        folder_path = os.path.join(OUTPUT_DIRECTORY, property_folder)
+def process_checked_rows(checked_rows):
+    """Generate and attach files for (row id, row data) pairs concurrently."""
+    list(_file_pool.map(lambda checked_row: process_property(*checked_row), checked_rows))
 
-        if not os.path.isdir(folder_path):
-            continue
 
-        excel_files = [f for f in os.listdir(folder_path) if f.endswith(".xlsx") and not f.startswith("~$")]
-        if not excel_files:
-            continue
+def process_rows(row_ids):
+    """Fetch a batch of rows by id, then generate and attach files for those still checked."""
+    # One narrowed get_sheet call for the whole batch; it also drops rows whose box was cleared
+    process_checked_rows(fetch_smartsheet_data(row_ids))
 
-        excel_file_path = os.path.join(folder_path, excel_files[0])
-        row_id = row_id_map.get(property_folder, None)
 
-        if not row_id:
-            continue
+# Webhook rows are processed off the request thread so Smartsheet gets its 200 straight away
+JOB_Q = queue.Queue()
+_pending_rows = set()  # Row ids queued or in progress, used to drop redelivered events
+_pending_lock = threading.Lock()
 
-        print(f"📤 Attaching {excel_file_path} to Smartsheet row {row_id}")
 
+def _worker():
+    """Process queued batches of row ids until the app exits."""
+    while True:
+        row_ids = JOB_Q.get()
         try:
-            with open(excel_file_path, 'rb') as file:
-                client.Attachments.attach_file_to_row(
-                    SHEET_ID, row_id,
-                    (os.path.basename(excel_file_path), file, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-                )
-            print(f"✅ Successfully attached: {excel_file_path}")
-        except smartsheet.exceptions.ApiError as e:
-            print(f"❌ Smartsheet API Error: {e}")
+            process_rows(row_ids)
+        except Exception:
+            log.exception("❌ Failed to process rows %s", row_ids)
+        finally:
+            with _pending_lock:
+                _pending_rows.difference_update(row_ids)
+            JOB_Q.task_done()
 
-    print("🎉 All files attached successfully!")
+
+for _ in range(WEBHOOK_WORKERS):
+    threading.Thread(target=_worker, daemon=True).start()
 
 
 @app.route("/webhook", methods=["POST", "GET"])
@@ -115,26 +412,58 @@ def webhook_listener():
     if request.method == "GET":
         challenge = request.args.get("smartsheetHookChallenge")
         if challenge:
-            print(f"Smartsheet verification request received: {challenge}")
+            log.info("Smartsheet verification request received: %s", challenge)
             return challenge, 200  # Respond with the challenge string for verification
         return "✅ Webhook is set up correctly!", 200  # For browser testing
 
     elif request.method == "POST":
-        data = request.get_json()
-        print(f"📥 Webhook received! Data: {json.dumps(data, indent=4)}")
-
-        # Proceed with processing webhook events...
-        df, row_id_map = fetch_smartsheet_data()
-        if df is not None and not df.empty:
-            create_property_files(df)
-            attach_excel_files_to_smartsheet(row_id_map)
-            return jsonify({"message": "Files updated & attached!"}), 200
-        else:
-            return jsonify({"message": "No checked rows found!"}), 400
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict) or not isinstance(data.get("events"), list):
+            return "", 200
+
+        # Ignore payloads with no ticked 'Check Box' before doing any other work
+        relevant = [
+            event for event in data["events"]
+            if isinstance(event, dict) and isinstance(event.get("rowId"), int) and is_check_box_event(event)
+        ]
+        if not relevant:
+            return "", 200
+
+        log.info("📥 Webhook received! Data: %s", data)
+
+        # Queue the ticked rows as one batch; the workers fetch them
+        row_ids = []
+        with _pending_lock:
+            for event in relevant:
+                row_id = event["rowId"]
+                if row_id in _pending_rows:
+                    continue
+                _pending_rows.add(row_id)
+                row_ids.append(row_id)
+
+        if row_ids:
+            JOB_Q.put(row_ids)
+        return jsonify({"message": f"{len(row_ids)} row(s) queued for processing"}), 200
+
+@app.cli.command("sync")
+def sync_command():
+    """Rescan the whole sheet and build and attach a file for every checked row.
+
+    Run with `flask --app app sync` to catch up on rows whose webhook events were missed.
+    Set SMARTSHEET_FILTER_ID to a saved sheet filter on 'Check Box' so only checked rows are downloaded.
+    """
+    checked_rows = fetch_smartsheet_data()
+    if not checked_rows:
+        log.info("No checked rows found!")
+        return
+
+    process_checked_rows(checked_rows)
+    log.info("🎉 All files attached successfully!")
 
 @app.route("/", methods=["GET"])
 def home():
     return "✅ Smartsheet Automation is Running!", 200
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    # Local runs only; production is served by gunicorn (see Procfile)
+    app.run()